@@ -1,57 +1,220 @@
-from typing import Literal, Union
+import ast
+import operator
+from array import array
+from dataclasses import dataclass
+from functools import lru_cache
+from types import CodeType, FunctionType
+from typing import Any, Callable, Literal, Optional, Union
 
-from sheet_primitives import CellGetter, CellKey, CellValue
+from sheet_primitives import CellGetter, CellRef, CellValue, Numeric
 
-Operand = Union["Formula", CellKey]
 Operation = Literal["+", "-", "*", "/"]
-# XXX: Is it possible to refactor expressions to be just another formula?
-# One possibility might involve removing the tuples and sub-classing the formula
-Expression = Union[Operand, tuple[Literal["="], "Expression"], tuple[Operation, "Expression", "Expression"]]
+Opcode = int
+# Formulas are compiled into a flat postfix program of (opcode, argument) pairs, with the opcodes
+# packed one byte each. The parser already emits binary nodes keyed by opcode so compiling them is a straight copy.
+LOAD_CELL, LOAD_CONST, ADD, SUB, MUL, DIV, NEG = range(7)
+OPCODES: dict[Operation, Opcode] = {"+": ADD, "-": SUB, "*": MUL, "/": DIV}
+OPERATIONS = {opcode: operation for operation, opcode in OPCODES.items()}
+NUMERIC_TYPES = (int, float)
+AST_OPERATIONS: dict[Opcode, type[ast.operator]] = {ADD: ast.Add, SUB: ast.Sub, MUL: ast.Mult, DIV: ast.Div}
+BINARY_OPERATIONS: dict[Opcode, Callable[[Any, Any], Any]] = {
+    ADD: operator.add,
+    SUB: operator.sub,
+    MUL: operator.mul,
+    DIV: operator.truediv,
+}
+
+# Expression tree built by the parser. Nodes are immutable so identical leaves can be shared between formulas.
+@dataclass(frozen=True, slots=True)
+class Reference:
+    cell: CellRef
+
+@dataclass(frozen=True, slots=True)
+class Constant:
+    value: Numeric
+
+@dataclass(frozen=True, slots=True)
+class UnaryNeg:
+    operand: "Expression"
+
+@dataclass(frozen=True, slots=True)
+class BinOp:
+    op: Opcode
+    left: "Expression"
+    right: "Expression"
+
+Expression = Union[Reference, Constant, UnaryNeg, BinOp]
+
 class Formula:
-    def __init__(self, get_cell: CellGetter, expression: Expression, negated = False):
+    __slots__ = (
+        "_get_cell",
+        "_expression",
+        "references",
+        "_ops",
+        "_args",
+        "_fn",
+        "_guarded_fn",
+        "_numeric_fn",
+    )
+
+    def __init__(self, get_cell: CellGetter, expression: Expression) -> None:
         self._get_cell = get_cell
         self._expression = expression
-        self._negated = negated
+        self.references: set[CellRef] = set()
+        self._ops, self._args = self._compile()
+        # Generated lazily, most formulas are only ever computed through one of them
+        self._fn: Optional[Callable[[], CellValue]] = None
+        self._guarded_fn: Optional[Callable[[], CellValue]] = None
+        self._numeric_fn: Optional[Callable[[], CellValue]] = None
 
     def compute(self) -> CellValue:
-        val = self._compute_expression(self._expression)
-        if self._negated:
-            if isinstance(val, str):
-                raise ValueError("Cannot negate a string.")
-            val = -val
-        return val
-    
-    def _compute_expression(self, expression: Expression) -> CellValue:
-        if isinstance(expression, int) or isinstance(expression, float):
-            return expression
-
-        if isinstance(expression, CellKey):
-            return self._get_cell(expression)
-
-        if isinstance(expression, Formula):
-            return expression.compute()
-
-        if expression[0] == "=":
-            return self._compute_expression(expression[1])
-        
-        left_hand = self._compute_expression(expression[1])
-        right_hand = self._compute_expression(expression[2])
-
-        if isinstance(left_hand, str) and isinstance(right_hand, str):
-            if expression[0] == "+":
-                return left_hand + right_hand
-
-        if any([
-            isinstance(left_hand, type1) and isinstance(right_hand, type2)
-            for type1, type2 in [(int, int), (float, float), (int, float), (float, int)]
-        ]):
-            if expression[0] == "*":
-                return left_hand * right_hand
-            elif expression[0] == "/":
-                return left_hand / right_hand
-            elif expression[0] == "+":
-                return left_hand + right_hand
-            elif expression[0] == "-":
-                return left_hand - right_hand
-
-        raise ValueError(f"Unexpected operation '{expression[0]}' on operands '{left_hand}' and '{right_hand}'")
+        if self._fn is None:
+            self._fn = self._guarded_fn = self._specialize(guarded=True)
+        return self._fn()
+
+    # Lets the owner promise that every referenced cell currently holds a number, which skips the
+    # operand type checks. The promise must be withdrawn before any referenced cell changes.
+    def assume_numeric(self, numeric: bool) -> None:
+        if not numeric:
+            self._fn = self._guarded_fn
+            return
+        if self._numeric_fn is None:
+            self._numeric_fn = self._specialize(guarded=False)
+        self._fn = self._numeric_fn
+
+    # Callers that already loaded the referenced cells pass them in so they are not read a second time
+    def _interpret(self, loaded: Optional[dict[CellRef, CellValue]] = None) -> CellValue:
+        get_cell = self._get_cell if loaded is None else loaded.__getitem__
+        binary_operations = BINARY_OPERATIONS
+        stack: list[CellValue] = []
+        append = stack.append
+        pop = stack.pop
+        for op, arg in zip(self._ops, self._args):
+            if op == LOAD_CELL:
+                append(get_cell(arg))
+            elif op == LOAD_CONST:
+                append(arg)
+            elif op == NEG:
+                val = pop()
+                if not isinstance(val, NUMERIC_TYPES):
+                    raise ValueError("Cannot negate a string.")
+                append(-val)
+            else:
+                right_hand = pop()
+                left_hand = pop()
+                if not (
+                    isinstance(left_hand, NUMERIC_TYPES) and isinstance(right_hand, NUMERIC_TYPES)
+                    or op == ADD and isinstance(left_hand, str) and isinstance(right_hand, str)
+                ):
+                    raise ValueError(f"Unexpected operation '{OPERATIONS[op]}' on operands '{left_hand}' and '{right_hand}'")
+                append(binary_operations[op](left_hand, right_hand))
+        return stack[0]
+
+    def _compile(self) -> tuple[array, list]:
+        ops = array("B")
+        args: list = []
+        self._emit(self._expression, ops, args)
+        return ops, args
+
+    def _emit(self, expression: Expression, ops: array, args: list) -> None:
+        if isinstance(expression, Reference):
+            ops.append(LOAD_CELL)
+            args.append(expression.cell)
+            self.references.add(expression.cell)
+        elif isinstance(expression, Constant):
+            ops.append(LOAD_CONST)
+            args.append(expression.value)
+        elif isinstance(expression, UnaryNeg):
+            self._emit(expression.operand, ops, args)
+            ops.append(NEG)
+            args.append(None)
+        else:
+            self._emit(expression.left, ops, args)
+            self._emit(expression.right, ops, args)
+            ops.append(expression.op)
+            args.append(None)
+
+    # Lowers the program to a function that loads every referenced cell once and evaluates the formula as a
+    # single Python expression. The cell getter, the interpreter, the referenced cells and the constants are
+    # bound as defaults so they are fast locals, which also lets formulas of the same shape share one code
+    # object. Unless the caller vouches for numeric operands, non-numeric ones fall back to the interpreter's
+    # type checks.
+    def _specialize(self, guarded: bool) -> Callable[[], CellValue]:
+        cells: dict[CellRef, int] = {}
+        constants: list[Any] = []
+        slots: list[Optional[int]] = []
+        for op, arg in zip(self._ops, self._args):
+            if op == LOAD_CELL:
+                slots.append(cells.setdefault(arg, len(cells)))
+            elif op == LOAD_CONST:
+                slots.append(len(constants))
+                constants.append(arg)
+            else:
+                slots.append(None)
+        code = _generate(guarded, self._ops.tobytes(), tuple(slots))
+        defaults = (self._get_cell, self._interpret, NUMERIC_TYPES, *cells, *constants)
+        return FunctionType(code, globals(), "_f", defaults)
+
+
+# Code only depends on the shape of the program: the opcodes and which cell or constant each load reads.
+# Bounded since every distinct formula structure would otherwise keep its code alive.
+@lru_cache(maxsize=4096)
+def _generate(guarded: bool, ops: bytes, slots: tuple[Optional[int], ...]) -> CodeType:
+    cells: list[str] = []
+    constants: list[str] = []
+    stack: list[ast.expr] = []
+    for op, slot in zip(ops, slots):
+        if op == LOAD_CELL:
+            if slot == len(cells):
+                cells.append(f"a{slot}")
+            stack.append(_name(f"a{slot}"))
+        elif op == LOAD_CONST:
+            constants.append(f"c{slot}")
+            stack.append(_name(f"c{slot}"))
+        elif op == NEG:
+            stack.append(ast.UnaryOp(ast.USub(), stack.pop()))
+        else:
+            right_hand = stack.pop()
+            left_hand = stack.pop()
+            stack.append(ast.BinOp(left_hand, AST_OPERATIONS[op](), right_hand))
+
+    indices = range(len(cells))
+    body: list[ast.stmt] = [
+        ast.Assign([ast.Name(f"a{index}", ast.Store())], _call("g", _name(f"k{index}"))) for index in indices
+    ]
+    if guarded and cells:
+        checks = [_call("isinstance", _name(f"a{index}"), _name("numeric")) for index in indices]
+        loaded = ast.Dict([_name(f"k{index}") for index in indices], [_name(f"a{index}") for index in indices])
+        body.append(ast.If(
+            ast.UnaryOp(ast.Not(), ast.BoolOp(ast.And(), checks) if len(checks) > 1 else checks[0]),
+            [ast.Return(_call("interpret", loaded))],
+            [],
+        ))
+    body.append(ast.Return(stack[0]))
+
+    # Every parameter gets its default when the function is instantiated for a formula
+    params = ["g", "interpret", "numeric", *(f"k{index}" for index in indices), *constants]
+    function = ast.FunctionDef(
+        name="_f",
+        args=ast.arguments(
+            posonlyargs=[],
+            args=[ast.arg(param) for param in params],
+            kwonlyargs=[],
+            kw_defaults=[],
+            defaults=[],
+        ),
+        body=body,
+        decorator_list=[],
+    )
+    module = ast.fix_missing_locations(ast.Module([function], type_ignores=[]))
+    namespace: dict = {}
+    exec(compile(module, "<formula>", "exec"), namespace)
+    return namespace["_f"].__code__
+
+
+def _name(identifier: str) -> ast.Name:
+    return ast.Name(identifier, ast.Load())
+
+
+def _call(function: str, *args: ast.expr) -> ast.Call:
+    return ast.Call(_name(function), list(args), [])
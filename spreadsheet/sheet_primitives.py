@@ -1,10 +1,33 @@
-from typing import Callable, Union
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Union
+
+if TYPE_CHECKING:
+    from formula import Formula
 
 Row = int
 Col = str
 CellKey = str
+CellRef = tuple[Row, Col]
 CellValue = Union[str, int, float, "Formula"]
-CellGetter = Callable[[Union[CellKey]], CellValue]
+CellGetter = Callable[[CellRef], CellValue]
 Numeric = Union[int, float]
-DIGITS = ("0", "1", "2", "3", "4", "5", "6", "7", "8", "9")
-ARITHMETIC_OPERATIONS = ("+", "-", "*", "/")
+ARITHMETIC_OPERATIONS = "+-*/"
+
+# Cell keys repeat heavily, so each distinct key is only validated and converted once. The cache is
+# bounded since callers can pass arbitrarily many distinct keys.
+@lru_cache(maxsize=65536)
+def parse_cell_key(cell_key: CellKey) -> CellRef:
+    if len(cell_key) < 2:
+        raise KeyError("Malformed cell key.")
+    col = cell_key[0]
+    if not "A" <= col <= "Z":
+        raise KeyError("Malformed cell key. Expected first half to be a character between A and Z.")
+    row_id = cell_key[1:]
+    # isdigit() alone also accepts non-ASCII digits that int() rejects or reads differently
+    if not (row_id.isascii() and row_id.isdigit()):
+        raise KeyError("Malformed cell key. Expected second half to be integer row identifier")
+
+    row = int(row_id) - 1
+    if row < 0:
+        raise KeyError("Malformed cell key. Expected row identifier to be greater than 0.")
+    return row, col
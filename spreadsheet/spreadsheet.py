@@ -1,101 +1,229 @@
+import re
 from collections import deque
-from copy import deepcopy
-from typing import cast, Callable, Literal, Union
+from typing import cast, Any, Callable, Literal, Union
 
-from formula import Formula
+from formula import Formula, NUMERIC_TYPES, Reference
 from formula_parser import FormulaParser
-from sheet_primitives import CellKey, CellValue, Col, Row
+from sheet_primitives import CellKey, CellRef, CellValue, Col, Row, parse_cell_key
+
+# Decimal numbers with an optional sign, fraction and exponent. Ints are the matches with neither of the groups.
+_NUMBER_RE = re.compile(r"[+-]?(?:[0-9]+|(?=\.[0-9]))(\.[0-9]*)?([eE][+-]?[0-9]+)?\Z")
 
 class Spreadsheet:
-    def __init__(self):
-        self._cells: list[dict[Col, CellValue]] = []
+    def __init__(self) -> None:
+        # One flat dict for the whole sheet: sparse sheets pay for occupied cells only, with no per-row
+        # containers, and reads are normally served by _value_cache before _cells is touched.
+        self._cells: dict[CellRef, CellValue] = {}
+        self._value_cache: dict[CellRef, CellValue] = {}
+        # Formulas that failed to compute, so reads and dependents reuse the error instead of recomputing
+        self._errors: dict[CellRef, Exception] = {}
+        self._dependents: dict[CellRef, set[CellRef]] = {}
+        self._precedents: dict[CellRef, list[CellRef]] = {}
+        self._leaf_cache: dict[CellKey, Reference] = {}
+        # Cells written since the last recompute. Reads flush them, so a batch of writes recomputes each
+        # affected formula once.
+        self._dirty: set[CellRef] = set()
 
     def set_cell(self, cell_key: CellKey, cell_value: str) -> None:
-        row, col = self._parse_key(cell_key)
+        row, col = parse_cell_key(cell_key)
+        stripped_val = cell_value.strip()
+        # The new value is fully built before the graph is touched, so a failing write leaves the cell as it was
+        value: CellValue = cell_value
+        if len(cell_value) > 0 and stripped_val[0] == "=":
+            value = FormulaParser.parse_formula(self._get_cell, stripped_val, leaf_cache=self._leaf_cache)
+            precedents = list(value.references)
+            if self._reaches((row, col), set(precedents)):
+                raise ValueError(f"Circular reference. {cell_key} depends on itself.")
+        elif number := _NUMBER_RE.match(stripped_val):
+            try:
+                value = int(stripped_val) if number.lastindex is None else float(stripped_val)
+            except ValueError:
+                # Integers past int()'s digit limit are stored as floats
+                value = float(stripped_val)
 
-        if row >= len(self._cells):
-            self._extend_rows(2 * row + 1)
+        self._remove_dependencies((row, col))
+        self._cells[(row, col)] = value
+        if isinstance(value, Formula):
+            self._add_dependencies((row, col), precedents)
+        self._dirty.add((row, col))
 
+    def get_cell(self, cell_key: Union[CellKey]) -> CellValue:
+        cell_ref = parse_cell_key(cell_key)
+        if self._dirty:
+            self.recompute_all()
+        return self._get_cell(cell_ref)
 
-        stripped_val = cell_value.strip()
+    def recompute_all(self) -> None:
+        # The dirty set is only cleared once the flush finishes, so an interrupted one is redone on the next read
+        affected = self._collect_dependents(self._dirty)
+        for ref in affected:
+            self._value_cache.pop(ref, None)
+            self._errors.pop(ref, None)
+            value = self._cells.get(ref)
+            if isinstance(value, Formula):
+                value.assume_numeric(False)
 
-        if self._set_int(row, col, stripped_val):
-            return
-        elif self._set_float(row, col, stripped_val):
-            return
-        elif len(cell_value) > 0 and stripped_val[0] == "=":
-            parser = FormulaParser()
-            self._cells[row][col] = parser.parse_formula(self.get_cell, stripped_val)
-        else:
-            self._cells[row][col] = cell_value
+        # Kahn's algorithm over the affected subgraph, so every formula is computed
+        # once and only after all of its precedents.
+        in_degree = dict.fromkeys(affected, 0)
+        for ref in affected:
+            for dependent in self._dependents.get(ref, ()):
+                in_degree[dependent] += 1
+        ready = deque(ref for ref, degree in in_degree.items() if degree == 0)
+        while ready:
+            current = ready.popleft()
+            self._evaluate(current)
+            for dependent in self._dependents.get(current, ()):
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    ready.append(dependent)
+        self._dirty = set()
 
-    def get_cell(self, cell_key: Union[CellKey]) -> CellValue:
-        return self._get_cell(cell_key)
+    def sort_rows_by_column(self, col: Col, reverse: bool = False) -> None:
+        rows: dict[Row, list[tuple[Col, CellValue]]] = {}
+        # Mixed value types are not comparable and make the sort raise a TypeError
+        sort_values: dict[Row, Any] = {}
+        for (row, cell_col), value in self._cells.items():
+            rows.setdefault(row, []).append((cell_col, value))
+            if cell_col == col:
+                sort_values[row] = value
+        num_rows = max(rows, default=-1) + 1
+
+        # Rows without a value in the column keep their relative order at the end, even when reversed
+        order: list[Row] = []
+        no_val: list[Row] = []
+        for row in range(num_rows):
+            (order if row in sort_values else no_val).append(row)
+        order.sort(key=sort_values.__getitem__, reverse=reverse)
+        order += no_val
+        unsorted_cells = self._cells
+        self._cells = {
+            (new_row, cell_col): value
+            for new_row, old_row in enumerate(order)
+            for cell_col, value in rows.get(old_row, ())
+        }
+        self._rebuild_dependencies()
+        if self._has_cycle():
+            self._cells = unsorted_cells
+            self._rebuild_dependencies()
+            raise ValueError("Circular reference. Sorting would make a formula depend on itself.")
+        # Formulas address cells by key, so every cached value is stale once rows move. Marking every cell
+        # dirty lets the next read recompute the whole sheet once, in dependency order.
+        self._value_cache.clear()
+        self._errors.clear()
+        self._dirty = set(self._cells)
 
-    def sort_rows_by_column(self, col: Col, reverse = False) -> None:
-        to_sort = sorted(
-            filter(lambda row: col in row, self._cells),
-            key=lambda row: row[col],
-            reverse=reverse
+
+    def _add_dependencies(self, cell_ref: CellRef, precedents: list[CellRef]) -> None:
+        self._precedents[cell_ref] = precedents
+        for precedent in precedents:
+            self._dependents.setdefault(precedent, set()).add(cell_ref)
+
+    def _remove_dependencies(self, cell_ref: CellRef) -> None:
+        for precedent in self._precedents.pop(cell_ref, []):
+            dependents = self._dependents.get(precedent)
+            if dependents is not None:
+                dependents.discard(cell_ref)
+
+    # Depth-first search through the dependents graph. Searching downstream from the written cell keeps
+    # the check O(1) for cells nothing depends on yet, which is every cell of a sheet being loaded in order.
+    def _reaches(self, start: CellRef, targets: set[CellRef]) -> bool:
+        to_visit = [start]
+        visited = {start}
+        while to_visit:
+            current = to_visit.pop()
+            if current in targets:
+                return True
+            for dependent in self._dependents.get(current, ()):
+                if dependent not in visited:
+                    visited.add(dependent)
+                    to_visit.append(dependent)
+        return False
+
+    def _has_cycle(self) -> bool:
+        in_degree = {cell_ref: len(precedents) for cell_ref, precedents in self._precedents.items()}
+        ready = deque(
+            cell_ref for cell_ref in self._dependents if not self._precedents.get(cell_ref)
         )
-        no_val = filter(lambda row: col not in row, self._cells)
-        self._cells = to_sort + list(no_val)
+        while ready:
+            current = ready.popleft()
+            for dependent in self._dependents.get(current, ()):
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    ready.append(dependent)
+        return any(in_degree.values())
 
+    def _rebuild_dependencies(self) -> None:
+        self._dependents = {}
+        self._precedents = {}
+        for cell_ref, value in self._cells.items():
+            if isinstance(value, Formula):
+                self._add_dependencies(cell_ref, list(value.references))
 
-    def _extend_rows(self, num_rows: int) -> None:
-        for _ in range(num_rows - len(self._cells)):
-            self._cells.append({})
-    
-    def _set_int(self, row: Row, col: Col, val: str) -> bool:
-        try:
-            self._cells[row][col] = int(val)
-            return True
-        except ValueError:
-            return False
+    def _collect_dependents(self, cell_refs: set[CellRef]) -> set[CellRef]:
+        to_visit = deque(cell_refs)
+        visited = set(cell_refs)
+        while to_visit:
+            current = to_visit.popleft()
+            for dependent in self._dependents.get(current, ()):
+                if dependent not in visited:
+                    visited.add(dependent)
+                    to_visit.append(dependent)
+        return visited
 
-    def _set_float(self, row: Row, col: Col, val: str) -> bool:
+    def _evaluate(self, cell_ref: CellRef) -> None:
+        value = self._cells.get(cell_ref)
+        if not isinstance(value, Formula):
+            # Plain values are cached too, so every read is served by a single dict lookup
+            if value is not None:
+                self._value_cache[cell_ref] = value
+            return
+        precedents = self._precedents[cell_ref]
+        errors = self._errors
+        for precedent in precedents:
+            error = errors.get(precedent)
+            if error is not None:
+                # Formulas load every operand, so computing this one would only raise the same error again
+                errors[cell_ref] = error
+                return
+        # Only cached values are checked: an uncached precedent just keeps the guarded path, which accepts anything
+        value_cache = self._value_cache
+        value.assume_numeric(all(isinstance(value_cache.get(precedent), NUMERIC_TYPES) for precedent in precedents))
         try:
-            self._cells[row][col] = float(val)
-            return True
-        except ValueError:
-            return False
+            value_cache[cell_ref] = value.compute()
+        except (ArithmeticError, LookupError, ValueError) as error:
+            # Leave the cell uncached so get_cell surfaces the error
+            errors[cell_ref] = error
 
-    def _get_cell(self, cell_key: CellKey) -> CellValue:
-        row, col = self._parse_key(cell_key)
-        value = self._cells[row][col]
+    # Formulas read their operands through here with keys already resolved at parse time
+    def _get_cell(self, cell_ref: CellRef) -> CellValue:
+        cached = self._value_cache.get(cell_ref)
+        if cached is not None:
+            return cached
+        error = self._errors.get(cell_ref)
+        if error is not None:
+            # Drop the previous read's traceback, otherwise every read would keep adding frames to it
+            raise error.with_traceback(None)
+        value = self._cells[cell_ref]
 
         if isinstance(value, int) or isinstance(value, float) or isinstance(value, str):
+            self._value_cache[cell_ref] = value
             return value
 
         if isinstance(value, Formula):
-            return value.compute()
+            computed = value.compute()
+            self._value_cache[cell_ref] = computed
+            return computed
         
         raise ValueError(f"Unexpected cell contents: {str(value)}")
 
-    def _parse_key(self, cell_key: CellKey) -> tuple[int, str]:
-        if len(cell_key) < 2:
-            raise KeyError("Malformed cell key.")
-
-        col = cell_key[0]
-        ord_col = ord(col)
-        if ord("A") > ord_col or ord("Z") < ord_col:
-            raise KeyError("Malformed cell key. Expected first half to be a character between A and Z.")
-
-        try:
-            row = int(cell_key[1:]) - 1
-        except ValueError:
-            raise KeyError("Malformed cell key. Expected second half to be integer row identifier")
-        if row < 0:
-            raise KeyError("Malformed cell key. Expected row identifier to be greater than 0.")
-
-        return row, col
-
-
-
 # TODO: Column filtering
 # TODO: Handle ranges and functions (start with SUM over a range)
 # TODO: Implement performance profiler
 if __name__ == "__main__":
+    from time import perf_counter
+    from traceback import extract_tb
+
     s = Spreadsheet()
     s.set_cell("A1", "3")
     s.set_cell("A2", "2")
@@ -120,11 +248,11 @@ if __name__ == "__main__":
     assert s.get_cell("A12") == 10
 
     s.set_cell("A14", "=-A1")
-    assert s.get_cell("A14") == -int(s.get_cell("A1"))
+    assert s.get_cell("A14") == -cast(int, s.get_cell("A1"))
     s.set_cell("A13", "=-A12")
-    assert s.get_cell("A12") == -int(s.get_cell("A13"))
+    assert s.get_cell("A12") == -cast(int, s.get_cell("A13"))
     s.set_cell("A13", "=-(A12+A12)")
-    assert 2 * int(s.get_cell("A12")) == -int(s.get_cell("A13"))
+    assert 2 * cast(int, s.get_cell("A12")) == -cast(int, s.get_cell("A13"))
     s.set_cell("A13", "=-A12+A12")
     assert s.get_cell("A13") == 0
     s.set_cell("A13", "=-(A12)+A12")
@@ -177,11 +305,28 @@ if __name__ == "__main__":
     s.set_cell("A2", "2.3")
     s.set_cell("A3", "=A1+A2")
     assert s.get_cell("A3") == 3.4 + 2.3
+    s.set_cell("A2", "-.5e1")
+    assert s.get_cell("A2") == -5.0
+    s.set_cell("A2", "+7")
+    assert s.get_cell("A2") == 7 and isinstance(s.get_cell("A2"), int)
+    s.set_cell("A2", "inf")
+    assert s.get_cell("A2") == "inf"
+    s.set_cell("A2", "9" * 5000)
+    assert s.get_cell("A2") == float("inf")
+    s.set_cell("A2", "2.3")
 
     s.set_cell("A3", "=A1+2")
     assert s.get_cell("A3") == 3.4 + 2
     s.set_cell("A3", "=A1+2.3")
     assert s.get_cell("A3") == 3.4 + 2.3
+    s.set_cell("A3", "=A1/A2")
+    assert s.get_cell("A3") == 3.4 / 2.3
+    s.set_cell("A3", "=A1-A2-A1")
+    assert s.get_cell("A3") == 3.4 - 2.3 - 3.4
+    s.set_cell("A3", "=A2/A1*A1+4/2")
+    assert s.get_cell("A3") == 2.3 / 3.4 * 3.4 + 4 / 2
+    s.set_cell("A3", "=((A1+A2)*(A1-A2))+A1")
+    assert s.get_cell("A3") == ((3.4 + 2.3) * (3.4 - 2.3)) + 3.4
 
     new_s = Spreadsheet()
     new_s.set_cell("A1", "3")
@@ -198,3 +343,150 @@ if __name__ == "__main__":
     new_s.sort_rows_by_column("B", reverse=True)
     assert new_s.get_cell("A1") == 1
     assert new_s.get_cell("B1") == "b"
+    new_s.set_cell("A3", "5")
+    new_s.set_cell("A4", "4")
+    new_s.sort_rows_by_column("B", reverse=True)
+    assert [new_s.get_cell(f"A{row}") for row in range(1, 5)] == [1, 3, 5, 4]
+
+    cached_s = Spreadsheet()
+    cached_s.set_cell("A1", "1")
+    cached_s.set_cell("A2", "=A1+1")
+    cached_s.set_cell("A3", "=A2*2")
+    assert cached_s.get_cell("A3") == 4
+    cached_s.set_cell("A1", "2")
+    assert cached_s.get_cell("A3") == 6
+    cached_s.set_cell("A2", "=A1")
+    cached_s.set_cell("A1", "5")
+    assert cached_s.get_cell("A3") == 10
+    cached_s.set_cell("A1", "1")
+    cached_s.set_cell("A4", "=A3+A2")
+    cached_s.set_cell("A2", "=A1*3")
+    assert cached_s.get_cell("A4") == 9
+    cached_s.set_cell("A5", "=A4")
+    cached_s.set_cell("A1", "2")
+    cached_s.recompute_all()
+    assert cached_s.get_cell("A5") == 18
+    cached_s.recompute_all()
+    assert cached_s.get_cell("A4") == 18
+
+    specialized_s = Spreadsheet()
+    specialized_s.set_cell("A1", "2")
+    specialized_s.set_cell("A2", "3.5")
+    specialized_s.set_cell("A3", "=(A1+A2)*-A1-A2+A1*3")
+    assert specialized_s.get_cell("A3") == (2 + 3.5) * -2 - 3.5 + 2 * 3
+    specialized_s.set_cell("A1", "a")
+    value_error = False
+    try:
+        specialized_s.get_cell("A3")
+    except ValueError:
+        value_error = True
+    assert value_error
+    specialized_s.set_cell("B1", "=A2*2+A2")
+    specialized_s.set_cell("B2", "=B1*2+A2")
+    specialized_s.set_cell("B3", "=-(1+2)*A2+4/2")
+    assert specialized_s.get_cell("B1") == 3.5 * 2 + 3.5
+    assert specialized_s.get_cell("B2") == (3.5 * 2 + 3.5) * 2 + 3.5
+    assert specialized_s.get_cell("B3") == -(1 + 2) * 3.5 + 4 / 2
+    specialized_s.set_cell("B3", "=A2+1/0")
+    zero_division_error = False
+    try:
+        specialized_s.get_cell("B3")
+    except ZeroDivisionError:
+        zero_division_error = True
+    assert zero_division_error
+    specialized_s.set_cell("C1", "-0.0")
+    specialized_s.set_cell("C2", "=C1+0.0")
+    specialized_s.set_cell("C3", "=C1+-0.0")
+    assert str(specialized_s.get_cell("C2")) == "0.0"
+    assert str(specialized_s.get_cell("C3")) == "-0.0"
+
+    typed_s = Spreadsheet()
+    typed_s.set_cell("A1", "2")
+    typed_s.set_cell("A2", "=A1*3")
+    typed_s.set_cell("A3", "=A2+A1")
+    assert typed_s.get_cell("A3") == 8
+    typed_s.set_cell("A1", "a")
+    value_error = False
+    try:
+        typed_s.get_cell("A3")
+    except ValueError:
+        value_error = True
+    assert value_error
+
+    cyclic_s = Spreadsheet()
+    cyclic_s.set_cell("A1", "1")
+    cyclic_s.set_cell("A2", "=A1+1")
+    cyclic_s.set_cell("A3", "=A2*2")
+    for cell_key, formula in [("A1", "=A3"), ("A1", "=A1"), ("A2", "=A3-A1")]:
+        value_error = False
+        try:
+            cyclic_s.set_cell(cell_key, formula)
+        except ValueError:
+            value_error = True
+        assert value_error
+    assert cyclic_s.get_cell("A3") == 4
+
+    cyclic_s = Spreadsheet()
+    cyclic_s.set_cell("A1", "=A2")
+    cyclic_s.set_cell("A2", "5")
+    cyclic_s.set_cell("B1", "b")
+    cyclic_s.set_cell("B2", "a")
+    value_error = False
+    try:
+        cyclic_s.sort_rows_by_column("B")
+    except ValueError:
+        value_error = True
+    assert value_error
+    assert cyclic_s.get_cell("A1") == 5
+    cyclic_s.set_cell("C3", "1")
+    cyclic_s.set_cell("D3", "=C3+1")
+    assert cyclic_s.get_cell("D3") == 2
+    cyclic_s.set_cell("C3", "x")
+    value_error = False
+    try:
+        cyclic_s.sort_rows_by_column("B")
+    except ValueError:
+        value_error = True
+    assert value_error
+    value_error = False
+    try:
+        cyclic_s.get_cell("D3")
+    except ValueError:
+        value_error = True
+    assert value_error
+
+    failing_s = Spreadsheet()
+    failing_s.set_cell("A1", "=Z1")
+    for row in range(2, 401):
+        failing_s.set_cell(f"A{row}", f"=A{row - 1}+1")
+    failing_s.set_cell("C1", "5")
+    assert failing_s.get_cell("C1") == 5
+    key_error = False
+    try:
+        failing_s.get_cell("A400")
+    except KeyError:
+        key_error = True
+    assert key_error
+    traceback_lengths = []
+    for _ in range(3):
+        try:
+            failing_s.get_cell("A400")
+        except KeyError as error:
+            traceback_lengths.append(len(extract_tb(error.__traceback__)))
+    assert traceback_lengths[0] == traceback_lengths[-1]
+    failing_s.set_cell("Z1", "1")
+    assert failing_s.get_cell("A400") == 400
+    failing_s.sort_rows_by_column("Z")
+    assert failing_s.get_cell("A400") == 400
+
+    def load_chain(rows: int) -> float:
+        start = perf_counter()
+        chain_s = Spreadsheet()
+        chain_s.set_cell("A1", "1")
+        for row in range(2, rows + 1):
+            chain_s.set_cell(f"A{row}", f"=A{row - 1}+1")
+        assert chain_s.get_cell(f"A{rows}") == rows
+        return perf_counter() - start
+
+    # Loading must scale linearly: 8 times the rows may not take anywhere near 64 times as long
+    assert load_chain(8000) < 24 * load_chain(1000)